@@ -0,0 +1,487 @@
+"""
+Byte counter sources and sampling shared by the monitor entry points.
+"""
+import os
+import socket
+import fcntl
+import struct
+import array
+import ctypes
+import select
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+
+import numpy as np
+
+SIOCETHTOOL = 0x8946
+ETHTOOL_GSTRINGS = 0x0000001b
+ETHTOOL_GSSET_INFO = 0x00000037
+ETHTOOL_GSTATS = 0x0000001d
+ETH_SS_STATS = 0x1
+ETH_GSTRING_LEN = 32
+
+SAMPLES = 20
+INTERVAL = 0.1
+
+_IFR_STRUCT = struct.Struct('16sP')
+_GSSET_INFO = struct.Struct("IIQI")
+_GSSET_REPLY = struct.Struct("8xQI")
+_GSTRINGS_HDR = struct.Struct("III")
+_GSTATS_HDR = struct.Struct("II")
+_U64 = struct.Struct("Q")
+
+# SIOCETHTOOL picks the NIC from ifr_name, so any socket will do; share one
+_ETHTOOL_SOCK = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
+_ETHTOOL_FD = _ETHTOOL_SOCK.fileno()
+
+CLOCK_MONOTONIC = 1
+# timerfd reuses O_CLOEXEC, whose value differs between architectures
+TFD_CLOEXEC = os.O_CLOEXEC
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+class _Itimerspec(ctypes.Structure):
+    _fields_ = [("it_interval", _Timespec), ("it_value", _Timespec)]
+
+
+class Ethtool(object):
+    """
+    A class for interacting with the ethtool API to retrieve network interface card (NIC) statistics.
+    """
+
+    def __init__(self, ifname):
+        """
+        Initializes an Ethtool object.
+
+        Args:
+            ifname (str): The name of the network interface.
+
+        """
+        self.ifname = ifname
+        self._ifname_bytes = self.ifname.encode("utf-8").ljust(16, b'\x00')[:16]
+        self._ifr = bytearray(_IFR_STRUCT.size)
+        self._sset_info = array.array('B', bytes(_GSSET_INFO.size))
+
+    def _send_ioctl(self, data):
+        """
+        Sends an ioctl request to the network interface.
+
+        The ifreq buffer is reused between calls; only the data pointer is
+        rewritten.
+
+        Args:
+            data (array.array): The buffer to be sent; filled in by the kernel.
+
+        Returns:
+            int: The return value of the ioctl request.
+
+        """
+        _IFR_STRUCT.pack_into(self._ifr, 0, self._ifname_bytes, data.buffer_info()[0])
+        return fcntl.ioctl(_ETHTOOL_FD, SIOCETHTOOL, self._ifr, True)
+
+    def get_sset_len(self, set_id):
+        """
+        Retrieves the number of strings in a given set without fetching them.
+
+        Args:
+            set_id (int): The ID of the set.
+
+        Returns:
+            int: The number of strings in the set.
+
+        """
+        _GSSET_INFO.pack_into(self._sset_info, 0, ETHTOOL_GSSET_INFO, 0, 1 << set_id, 0)
+        self._send_ioctl(self._sset_info)
+        sset_mask, sset_len = _GSSET_REPLY.unpack_from(self._sset_info)
+        if sset_mask == 0:
+            sset_len = 0
+        return sset_len
+
+    def get_gstringset(self, set_id):
+        """
+        Retrieves the set of strings associated with a given set ID.
+
+        Args:
+            set_id (int): The ID of the set.
+
+        Yields:
+            str: The strings associated with the set.
+
+        """
+        sset_len = self.get_sset_len(set_id)
+
+        strings = array.array("B", _GSTRINGS_HDR.pack(ETHTOOL_GSTRINGS, ETH_SS_STATS, sset_len))
+        strings.extend(b'\x00' * sset_len * ETH_GSTRING_LEN)
+        self._send_ioctl(strings)
+        mv = memoryview(strings)
+        for i in range(sset_len):
+            offset = _GSTRINGS_HDR.size + ETH_GSTRING_LEN * i
+            s = bytes(mv[offset:offset+ETH_GSTRING_LEN]).split(b'\x00', 1)[0].decode("utf-8")
+            yield s
+
+    def get_nic_stats(self):
+        """
+        Retrieves the NIC statistics.
+
+        Yields:
+            tuple: A tuple containing the statistic name and its corresponding value.
+
+        """
+        strings = list(self.get_gstringset(ETH_SS_STATS))
+        n_stats = len(strings)
+
+        stats = array.array("B", _GSTATS_HDR.pack(ETHTOOL_GSTATS, n_stats))
+        stats.extend(bytes(_U64.size * n_stats))
+        self._send_ioctl(stats)
+        for i in range(n_stats):
+            value = _U64.unpack_from(stats, _GSTATS_HDR.size + _U64.size * i)[0]
+            yield (strings[i], value)
+
+    def init_two_stats(self, name_rx="rx_bytes_phy", name_tx="tx_bytes_phy"):
+        """
+        Resolves the positions of the rx/tx counters and allocates the stats buffer.
+
+        get_two_stats() calls it again whenever the number of statistics
+        changes (e.g. after ethtool -L), so the buffer always fits.
+
+        Args:
+            name_rx (str): The name of the receive byte counter.
+            name_tx (str): The name of the transmit byte counter.
+
+        """
+        self.name_rx = name_rx
+        self.name_tx = name_tx
+        strings = list(self.get_gstringset(ETH_SS_STATS))
+        self.n_stats = len(strings)
+        self.idx_rx = strings.index(name_rx)
+        self.idx_tx = strings.index(name_tx)
+
+        self._stats = array.array("B", _GSTATS_HDR.pack(ETHTOOL_GSTATS, self.n_stats))
+        self._stats.extend(bytes(_U64.size * self.n_stats))
+
+    def get_two_stats(self, idx_rx=None, idx_tx=None):
+        """
+        Retrieves two NIC statistics by index.
+
+        The kernel writes as many counters as the driver reports at call time,
+        so the stats count is re-checked first with the cheap GSSET_INFO ioctl
+        and the buffer is rebuilt when it changed.
+
+        Args:
+            idx_rx (int): The index of the first statistic, defaults to the one found by init_two_stats().
+            idx_tx (int): The index of the second statistic, defaults to the one found by init_two_stats().
+
+        Returns:
+            tuple: The values of the two statistics.
+
+        """
+        if self.get_sset_len(ETH_SS_STATS) != self.n_stats:
+            self.init_two_stats(self.name_rx, self.name_tx)
+        _GSTATS_HDR.pack_into(self._stats, 0, ETHTOOL_GSTATS, self.n_stats)
+        self._send_ioctl(self._stats)
+        if _GSTATS_HDR.unpack_from(self._stats)[1] != self.n_stats:
+            # the count changed between the two ioctls, retry with a fresh layout
+            self.init_two_stats(self.name_rx, self.name_tx)
+            return self.get_two_stats(idx_rx, idx_tx)
+        if idx_rx is None:
+            idx_rx = self.idx_rx
+        if idx_tx is None:
+            idx_tx = self.idx_tx
+        return (_U64.unpack_from(self._stats, _GSTATS_HDR.size + _U64.size * idx_rx)[0],
+                _U64.unpack_from(self._stats, _GSTATS_HDR.size + _U64.size * idx_tx)[0])
+
+
+class IBCounters(object):
+    """
+    Reads the InfiniBand port data counters directly from sysfs.
+    """
+
+    def __init__(self, mlx, port=1):
+        """
+        Opens the port_rcv_data/port_xmit_data counters of an InfiniBand device.
+
+        The files are kept open and re-read from offset 0 on every poll.
+
+        Args:
+            mlx (str): The name of the InfiniBand device.
+            port (int): The port number.
+
+        Raises:
+            OSError: If the device does not expose the counters.
+
+        """
+        counters = '/sys/class/infiniband/{}/ports/{}/counters'.format(mlx, port)
+        self._fd_rx = os.open(os.path.join(counters, 'port_rcv_data'), os.O_RDONLY)
+        try:
+            self._fd_tx = os.open(os.path.join(counters, 'port_xmit_data'), os.O_RDONLY)
+        except OSError:
+            os.close(self._fd_rx)
+            raise
+
+    def close(self):
+        """
+        Closes the counter files.
+        """
+        os.close(self._fd_rx)
+        os.close(self._fd_tx)
+
+    def get_two_stats(self):
+        """
+        Retrieves the received and transmitted byte counts.
+
+        Returns:
+            tuple: The rx and tx byte counts.
+
+        """
+        # the counters are in units of 4 bytes
+        return (int(os.pread(self._fd_rx, 32, 0)) * 4,
+                int(os.pread(self._fd_tx, 32, 0)) * 4)
+
+
+def open_counters(device):
+    """
+    Returns the cheapest available byte counter source for a device.
+
+    Uses the sysfs port counters on InfiniBand ports and ethtool statistics
+    otherwise. On RoCE (Ethernet) ports the port counters only count RDMA
+    traffic, while rx_bytes_phy/tx_bytes_phy count everything on the wire.
+
+    Args:
+        device (dict): The device as returned by get_ib_devices().
+
+    Returns:
+        IBCounters or Ethtool: An object whose get_two_stats() returns (rx, tx).
+
+    """
+    try:
+        with open('/sys/class/infiniband/{}/ports/1/link_layer'.format(device["mlx"]), 'r') as f:
+            link_layer = f.read().strip()
+    except OSError:
+        link_layer = None
+
+    counters = None
+    if link_layer == "InfiniBand":
+        try:
+            counters = IBCounters(device["mlx"])
+        except OSError:
+            pass
+    if counters is not None:
+        # some HCAs/VFs expose the files but fail to read them
+        try:
+            counters.get_two_stats()
+            return counters
+        except (OSError, ValueError):
+            counters.close()
+    eth = Ethtool(device["net"])
+    eth.init_two_stats()
+    return eth
+
+
+# find infiniBand devices
+def get_ib_devices():
+    ib_devices = []
+    try: 
+        p = sorted(os.listdir('/sys/class/infiniband'))
+    except FileNotFoundError:
+        #sys.exit("No InfiniBand devices found")
+        ib_devices = []
+        return ib_devices
+
+    for device in p:
+        if 'mlx' in device:
+            ib_devices.append({"mlx" :device, "net": os.listdir('/sys/class/infiniband/{}/device/net'.format(device))[0]})
+    return ib_devices
+
+# find ib devices that are up
+def get_up_ib_devices():
+    ib_devices = get_ib_devices()
+    up_ib_devices = []
+    for device in ib_devices:
+        netdevice = os.listdir('/sys/class/infiniband/{}/device/net'.format(device["mlx"]))[0]
+        if os.path.exists('/sys/class/infiniband/{}/device/net/{}'.format(device["mlx"], netdevice)):
+            with open('/sys/class/infiniband/{}/device/net/{}/operstate'.format(device["mlx"], netdevice), 'r') as f:
+                if f.read().strip() == 'up':
+                    up_ib_devices.append(device)
+    return up_ib_devices
+
+
+class DevState(object):
+    """
+    The counter source of one device and its row in the Monitor sample arrays.
+    """
+    __slots__ = ("mlx", "net", "eth", "row")
+
+    def __init__(self, mlx, net, eth, row):
+        self.mlx = mlx
+        self.net = net
+        self.eth = eth
+        self.row = row
+
+
+class Monitor(object):
+    """
+    Samples the rx/tx byte counters of a set of devices into ring buffers.
+
+    The samples of all devices live in two (devices, samples) int64 arrays
+    sharing one head column, so the whole fleet is diffed in one call.
+    """
+
+    def __init__(self, devices, samples=SAMPLES):
+        """
+        Opens a counter source per device and fills its buffers with the current values.
+
+        Args:
+            devices (list): The devices as returned by get_up_ib_devices().
+            samples (int): The number of samples kept per device.
+
+        """
+        self.devices = devices
+        self.samples = samples
+        # slot of the newest sample in the per-device ring buffers
+        self.head = 0
+        self.sample_dt = INTERVAL
+        # the counter reads block in the kernel without the GIL, poll devices in parallel
+        self._pool = ThreadPoolExecutor(max_workers=max(1, min(8, len(devices))))
+
+        self.rx = np.zeros((len(devices), samples), dtype=np.int64)
+        self.tx = np.zeros((len(devices), samples), dtype=np.int64)
+        self.devs = []
+        for i, device in enumerate(devices):
+            # keep one counter source per device open for the whole run
+            eth = open_counters(device)
+            self.rx[i], self.tx[i] = eth.get_two_stats()
+            self.devs.append(DevState(device["mlx"], device["net"], eth, i))
+        # time of the newest sample and the measured interval since the one before;
+        # taken after the fill so slow ethtool setup doesn't inflate the first interval
+        self.sample_t = monotonic()
+
+    def update(self):
+        """
+        Takes a new sample from every device.
+
+        Returns:
+            bool: Whether any device's window changed.
+
+        """
+        head = self.head = (self.head + 1) % self.samples
+        now = monotonic()
+        self.sample_dt = now - self.sample_t
+        self.sample_t = now
+        futures = [self._pool.submit(d.eth.get_two_stats) for d in self.devs]
+        new = np.array([f.result() for f in futures], dtype=np.int64).reshape(-1, 2)
+        # counters only grow, so a window stays flat (and its row looks the
+        # same) as long as the new sample equals the one it evicts
+        changed = bool((self.rx[:, head] != new[:, 0]).any() or (self.tx[:, head] != new[:, 1]).any())
+
+        self.rx[:, head] = new[:, 0]
+        self.tx[:, head] = new[:, 1]
+        return changed
+
+    def ordered(self, buf):
+        """
+        Returns the contents of a ring buffer, oldest sample first.
+
+        Args:
+            buf (numpy.ndarray): The rx or tx samples of one device or of all of them.
+
+        Returns:
+            numpy.ndarray: The reordered samples.
+
+        """
+        return np.concatenate((buf[..., self.head+1:], buf[..., :self.head+1]), axis=-1)
+
+    def diffs(self):
+        """
+        Returns the per-tick byte deltas of every device, oldest first.
+
+        Returns:
+            tuple: The rx and tx deltas as (devices, samples - 1) arrays.
+
+        """
+        return (np.diff(self.ordered(self.rx), axis=1),
+                np.diff(self.ordered(self.tx), axis=1))
+
+
+class Ticker(object):
+    """
+    A periodic wakeup driven by a timerfd registered with epoll.
+
+    Other fds (e.g. sysfs or netlink watches) can be added to the same epoll
+    set later. Falls back to sleeping until the next deadline where timerfd
+    is not available.
+    """
+
+    def __init__(self, interval=INTERVAL):
+        """
+        Creates and arms the timer.
+
+        Args:
+            interval (float): The tick period in seconds.
+
+        """
+        self.interval = interval
+        try:
+            self.fd = self._timerfd(interval)
+        except (AttributeError, OSError):
+            self.fd = None
+            self._next_t = monotonic()
+            return
+        self._epoll = select.epoll()
+        self._epoll.register(self.fd, select.EPOLLIN | select.EPOLLET)
+
+    @staticmethod
+    def _timerfd(interval):
+        """
+        Creates a CLOCK_MONOTONIC timerfd that expires every interval seconds.
+
+        Args:
+            interval (float): The timer period in seconds.
+
+        Returns:
+            int: The timerfd file descriptor.
+
+        Raises:
+            OSError: If the timer cannot be created or armed.
+            AttributeError: If libc does not provide timerfd.
+
+        """
+        if hasattr(os, "timerfd_create"):
+            # Python 3.13+
+            fd = os.timerfd_create(os.CLOCK_MONOTONIC, flags=os.TFD_CLOEXEC)
+            os.timerfd_settime(fd, initial=interval, interval=interval)
+            return fd
+
+        sec, nsec = int(interval), int(interval % 1 * 1e9)
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.timerfd_create(CLOCK_MONOTONIC, TFD_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        spec = _Itimerspec(_Timespec(sec, nsec), _Timespec(sec, nsec))
+        if libc.timerfd_settime(fd, 0, ctypes.byref(spec), None) < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        return fd
+
+    def wait(self):
+        """
+        Blocks until the next tick.
+
+        Returns:
+            int: The number of timer expirations since the previous call.
+
+        """
+        if self.fd is None:
+            self._next_t += self.interval
+            sleep(max(0.0, self._next_t - monotonic()))
+            return 1
+
+        expirations = 0
+        while not expirations:
+            for fd, _ in self._epoll.poll():
+                if fd == self.fd:
+                    # edge triggered: drain the counter so the next expiry fires again
+                    expirations += int.from_bytes(os.read(fd, 8), "little")
+        return expirations
@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 import sys
-import os
 import platform
-import socket
-import fcntl
-import struct
-import array
-from collections import OrderedDict
-from time import sleep
+from collections import OrderedDict, deque
+from operator import attrgetter
+from time import time
+
+import numpy as np
+
+from ib_monitor_core import SAMPLES, INTERVAL, Monitor, Ticker, get_up_ib_devices
 
 try: 
     import pynvml as nvidia_smi
@@ -23,15 +23,25 @@ from rich.table import Table
 from rich.text import Text
 from rich import box
 from rich.panel import Panel
-from fastcore.xtras import sparkline
 from datetime import datetime
 
-SIOCETHTOOL = 0x8946
-ETHTOOL_GSTRINGS = 0x0000001b
-ETHTOOL_GSSET_INFO = 0x00000037
-ETHTOOL_GSTATS = 0x0000001d
-ETH_SS_STATS = 0x1
-ETH_GSTRING_LEN = 32
+SPARK_DIVISOR = 1000
+# ticks of zero utilization after which an idle GPU is only polled every other tick
+IDLE_TICKS = 20
+# with auto refresh off, repaint at least this often so a terminal resize or
+# redraw isn't left blank on an idle host
+IDLE_REFRESH_TICKS = 10
+_TPUT_FMT = "{:.2f} / {:.2f} Mbps".format
+
+_BARS_U32 = np.array([ord(c) for c in "▁▂▃▄▅▆▇█"], dtype="<u4")
+
+def sparkline(values):
+    # render ints as a row of bars scaled between their min and max
+    d = np.asarray(values, dtype=np.int64)
+    if d.size == 0: return ""
+    lo = d.min(); span = max(d.max() - lo, 1)
+    idx = (d - lo) * (len(_BARS_U32) - 1) // span
+    return _BARS_U32[idx].tobytes().decode("utf-32-le")
 
 if GPUs: 
     try: 
@@ -42,91 +52,17 @@ if GPUs:
 if GPUs:
         
     gpu_utilization = {}
-    memory_utilization = {}
     deviceCount = nvidia_smi.nvmlDeviceGetCount()
+    # handles and names don't change at runtime, look them up once
+    gpu_handles = [nvidia_smi.nvmlDeviceGetHandleByIndex(i) for i in range(deviceCount)]
+    gpu_names = [nvidia_smi.nvmlDeviceGetName(h) for h in gpu_handles]
 
     for d in range(deviceCount):
-        gpu_utilization[d] = [0] * 20
-        memory_utilization[d] = [0] * 20
+        gpu_utilization[d] = deque([0] * SAMPLES, maxlen=SAMPLES)
         
 else: 
     deviceCount = 0
     
-class Ethtool(object):
-    """
-    A class for interacting with the ethtool API to retrieve network interface card (NIC) statistics.
-    """
-
-    def __init__(self, ifname):
-        """
-        Initializes an Ethtool object.
-
-        Args:
-            ifname (str): The name of the network interface.
-
-        """
-        self.ifname = ifname
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
-
-    def _send_ioctl(self, data):
-        """
-        Sends an ioctl request to the network interface.
-
-        Args:
-            data (bytes): The data to be sent.
-
-        Returns:
-            bytes: The response from the ioctl request.
-
-        """
-        ifr = struct.pack('16sP', self.ifname.encode("utf-8"), data.buffer_info()[0])
-        return fcntl.ioctl(self._sock.fileno(), SIOCETHTOOL, ifr)
-
-    def get_gstringset(self, set_id):
-        """
-        Retrieves the set of strings associated with a given set ID.
-
-        Args:
-            set_id (int): The ID of the set.
-
-        Yields:
-            str: The strings associated with the set.
-
-        """
-        sset_info = array.array('B', struct.pack("IIQI", ETHTOOL_GSSET_INFO, 0, 1 << set_id, 0))
-        self._send_ioctl(sset_info)
-        sset_mask, sset_len = struct.unpack("8xQI", sset_info)
-        if sset_mask == 0:
-            sset_len = 0
-
-        strings = array.array("B", struct.pack("III", ETHTOOL_GSTRINGS, ETH_SS_STATS, sset_len))
-        strings.extend(b'\x00' * sset_len * ETH_GSTRING_LEN)
-        self._send_ioctl(strings)
-        for i in range(sset_len):
-            offset = 12 + ETH_GSTRING_LEN * i
-            s = strings[offset:offset+ETH_GSTRING_LEN].tobytes().partition(b'\x00')[0].decode("utf-8")
-            yield s
-
-    def get_nic_stats(self):
-        """
-        Retrieves the NIC statistics.
-
-        Yields:
-            tuple: A tuple containing the statistic name and its corresponding value.
-
-        """
-        strings = list(self.get_gstringset(ETH_SS_STATS))
-        n_stats = len(strings)
-
-        stats = array.array("B", struct.pack("II", ETHTOOL_GSTATS, n_stats))
-        stats.extend(struct.pack('Q', 0) * n_stats)
-        self._send_ioctl(stats)
-        for i in range(n_stats):
-            offset = 8 + 8 * i
-            value = struct.unpack('Q', stats[offset:offset+8])[0]
-            yield (strings[i], value)
-
-
 def make_layout() -> Layout:
     layout = Layout(name="root")
     if deviceCount > 0:
@@ -147,139 +83,151 @@ def make_layout() -> Layout:
 class Header:
     """Display header with clock."""
 
+    def __init__(self):
+        # ctime() is fixed width, so the blinking colons stay in place
+        self._text = Text(datetime.now().ctime())
+        self._text.highlight_regex(":", "blink")
+        self._panel = Panel(self._text, box=box.SIMPLE)
+
     def __rich__(self) -> Panel:
-        grid = Table.grid()
-        grid.add_column(justify="left", ratio=1)
-        grid.add_column(justify="right", ratio=1)
-        text=datetime.now().ctime().replace(":", "[blink]:[/]")
-        
-        #grid.add_row(
-        #    text," |",
-            #f" {os.getlogin()}@{platform.node()}"
-        
-        
-        return Panel(grid, box=box.SIMPLE)
+        self._text.plain = datetime.now().ctime()
+        return self._panel
     
 class Footer:
-    
 
-    def __rich__(self) -> Panel:
+    def __init__(self):
         grid = Table.grid(expand=True)
         grid.add_column(justify="center", ratio=1)
 
         grid.add_row(
         platform.node(),
         )
-        #return Panel(grid, style="white on blue")
-        return Panel(grid)
-
-# find infiniBand devices
-def get_ib_devices():
-    ib_devices = []
-    try: 
-        p = sorted(os.listdir('/sys/class/infiniband'))
-    except FileNotFoundError:
-        #sys.exit("No InfiniBand devices found")
-        ib_devices = []
-        return ib_devices
+        #self._panel = Panel(grid, style="white on blue")
+        self._panel = Panel(grid)
 
-    for device in p:
-        if 'mlx' in device:
-            ib_devices.append({"mlx" :device, "net": os.listdir('/sys/class/infiniband/{}/device/net'.format(device))[0]})
-    return ib_devices
-
-# find ib devices that are up
-def get_up_ib_devices():
-    ib_devices = get_ib_devices()
-    up_ib_devices = []
-    for device in ib_devices:
-        netdevice = os.listdir('/sys/class/infiniband/{}/device/net'.format(device["mlx"]))[0]
-        if os.path.exists('/sys/class/infiniband/{}/device/net/{}'.format(device["mlx"], netdevice)):
-            with open('/sys/class/infiniband/{}/device/net/{}/operstate'.format(device["mlx"], netdevice), 'r') as f:
-                if f.read().strip() == 'up':
-                    up_ib_devices.append(device)
-    return up_ib_devices
+    def __rich__(self) -> Panel:
+        return self._panel
 
 ibd = get_up_ib_devices()
-stats = {}
-
-for device in ibd:
-    # initialize stats
-    d = Ethtool(device["net"])
-    ethtool_data = {k: v for k, v in d.get_nic_stats()}  
-    stats[device["mlx"]] = {}
-    stats[device["mlx"]]["rx_bytes_phy"] = [ethtool_data["rx_bytes_phy"]] * 20
-    stats[device["mlx"]]["tx_bytes_phy"] = [ethtool_data["tx_bytes_phy"]] * 20
-    
-def update_stats():
-    for device in ibd: 
-        d = Ethtool(device["net"])
-        ethtool_data = {k: v for k, v in d.get_nic_stats()}
-        
-        stats[device["mlx"]]["rx_bytes_phy"].append(ethtool_data["rx_bytes_phy"])
-        stats[device["mlx"]]["tx_bytes_phy"].append(ethtool_data["tx_bytes_phy"])
-        stats[device["mlx"]]["rx_bytes_phy"].pop(0)
-        stats[device["mlx"]]["tx_bytes_phy"].pop(0)
-    return stats
+monitor = Monitor(ibd)
+
+MAIN_TABLE = Table(expand=False, box=box.SIMPLE_HEAD, padding=(0,0,0,1))
+MAIN_TABLE.add_column("Device", justify="left", style="dark_orange", no_wrap=True)
+MAIN_TABLE.add_column("Net", justify="left", style="dark_orange", no_wrap=True)
+MAIN_TABLE.add_column("TX", justify="left", min_width=20, max_width=22)
+MAIN_TABLE.add_column("RX", justify="left", min_width=20, max_width=22)
+MAIN_TABLE.add_column("Throughput", justify="left", min_width=3)
+
+# each device with the cells that change every tick, in the order they appear in the row
+rows = []
+for d in sorted(monitor.devs, key=attrgetter("net")):
+    rows.append((d, (Text(), Text(), Text())))
+    MAIN_TABLE.add_row(d.mlx, d.net, *rows[-1][1])
+if len(ibd) == 0:
+    MAIN_TABLE.add_row("No InfiniBand Devices FOUND", "N/A", "N/A", "N/A", "N/A")
 
 def generate_table() -> Table:
-    # Generate rich table
+    # Refresh the cached rich table in place
     
-    stats = update_stats()
-    
-    table = Table(expand=False, box=box.SIMPLE_HEAD, padding=(0,0,0,1))
-    table.add_column("Device", justify="left", style="dark_orange", no_wrap=True)
-    table.add_column("Net", justify="left", style="dark_orange", no_wrap=True)
-    table.add_column("TX", justify="left", min_width=20, max_width=22)
-    table.add_column("RX", justify="left", min_width=20, max_width=22)
-    table.add_column("Throughput", justify="left", min_width=3)
-    
-    # TODO: Fix the list comprehension to be more understandable
-    
-    for device in sorted(ibd, key=lambda x: x["net"]):
-        table.add_row(
-            device["mlx"], device["net"], 
-            sparkline([(stats[device["mlx"]]["rx_bytes_phy"][i] - stats[device["mlx"]]["rx_bytes_phy"][i-1])//1000 for i in range(1, len(stats[device["mlx"]]["rx_bytes_phy"]))]), 
-            sparkline([(stats[device["mlx"]]["tx_bytes_phy"][i] - stats[device["mlx"]]["tx_bytes_phy"][i-1])//1000 for i in range(1, len(stats[device["mlx"]]["tx_bytes_phy"]))]), 
-            str(f'{(stats[device["mlx"]]["rx_bytes_phy"][-1] - stats[device["mlx"]]["rx_bytes_phy"][-2])/1000000:.2f} / {(stats[device["mlx"]]["tx_bytes_phy"][-1] - stats[device["mlx"]]["tx_bytes_phy"][-2])/1000000:.2f} Mbps'))
-    if len(ibd) == 0:
-        table.add_row("No InfiniBand Devices FOUND", "N/A", "N/A", "N/A", "N/A")
-    return table
+    rx_diffs, tx_diffs = monitor.diffs()
+    rx_spark = rx_diffs // SPARK_DIVISOR
+    tx_spark = tx_diffs // SPARK_DIVISOR
+    # the last delta is the newest sample against the one before it
+    rx_mbps = (rx_diffs[:, -1] * 8 / 1000000 / monitor.sample_dt).tolist()
+    tx_mbps = (tx_diffs[:, -1] * 8 / 1000000 / monitor.sample_dt).tolist()
+    for d, (rx_text, tx_text, tput_text) in rows:
+        i = d.row
+        rx_text.plain = sparkline(rx_spark[i])
+        tx_text.plain = sparkline(tx_spark[i])
+        tput_text.plain = _TPUT_FMT(rx_mbps[i], tx_mbps[i])
+    return MAIN_TABLE
+
+GPU_TABLE = Table(expand=False, box=box.SIMPLE_HEAD, padding=(0,0,0,1))
+GPU_TABLE.add_column("Device", justify="left", style="dark_orange", no_wrap=True)
+GPU_TABLE.add_column("GPU Utilization", justify="left", )
+GPU_TABLE.add_column("GPU %", justify="left", )
+GPU_TABLE.add_column("MEM %", justify="left", )
+
+gpu_cells = []
+for i in range(deviceCount):
+    gpu_cells.append((Text(), Text(), Text()))
+    GPU_TABLE.add_row(f"GPU {i} ({gpu_names[i]})", *gpu_cells[i])
+if deviceCount == 0:
+    GPU_TABLE.add_row("No GPUs FOUND", "N/A", "N/A", "N/A")
+
+# latest (util.gpu, util.memory, mem used, mem total) per GPU
+gpu_readings = [None] * deviceCount
+# consecutive zero utilization readings per GPU
+idle_streak = [0] * deviceCount
+gpu_tick = 0
+
+def update_gpu_stats():
+    global gpu_tick
+    gpu_tick += 1
+    changed = False
+    for i, h in enumerate(gpu_handles):
+        # an idle GPU's window is already flat, skipping a poll changes nothing on screen
+        if idle_streak[i] > IDLE_TICKS and gpu_tick % 2:
+            continue
+        util = nvidia_smi.nvmlDeviceGetUtilizationRates(h)
+        mem_info = nvidia_smi.nvmlDeviceGetMemoryInfo(h)
+        reading = (util.gpu, util.memory, mem_info.used, mem_info.total)
+        # the sparkline keeps shifting until the whole window holds the same value
+        window = gpu_utilization[i]
+        changed = changed or reading != gpu_readings[i] or min(window) != max(window)
+        gpu_utilization[i].append(util.gpu)
+        gpu_readings[i] = reading
+        if util.gpu == 0 and util.memory == 0:
+            idle_streak[i] += 1
+        else:
+            idle_streak[i] = 0
+    return changed
 
 def gpu_table() -> Table:
-    # Generate rich table
-    
-    table = Table(expand=False, box=box.SIMPLE_HEAD, padding=(0,0,0,1))
-    table.add_column("Device", justify="left", style="dark_orange", no_wrap=True)
-    table.add_column("GPU Utilization", justify="left", )
-    table.add_column("GPU %", justify="left", )
-    table.add_column("MEM %", justify="left", )
-    for i in range(deviceCount):
-        handle = nvidia_smi.nvmlDeviceGetHandleByIndex(i)
-        gpu_utilization[i].append(nvidia_smi.nvmlDeviceGetUtilizationRates(handle).gpu)
-        mem_info = nvidia_smi.nvmlDeviceGetMemoryInfo(handle)
-        memory_utilization = mem_info.used / mem_info.total * 100
-        gpu_utilization[i].pop(0)
-        table.add_row(f"GPU {i} ({nvidia_smi.nvmlDeviceGetName(handle)})", sparkline(gpu_utilization[i]), f"{gpu_utilization[i][-1]}%", f"{memory_utilization:.0f}%" f" ({mem_info.used // 1024**2} / {mem_info.total // 1024**2} MB)" f" (Busy: {nvidia_smi.nvmlDeviceGetUtilizationRates(nvidia_smi.nvmlDeviceGetHandleByIndex(i)).memory}%)")
+    # Refresh the cached rich table in place
     
-    if deviceCount == 0:
-        table.add_row("No GPUs FOUND", "N/A", "N/A", "N/A")
+    for i, (spark_text, gpu_text, mem_text) in enumerate(gpu_cells):
+        if gpu_readings[i] is None:
+            continue
+        util_gpu, util_mem, mem_used, mem_total = gpu_readings[i]
+        memory_utilization = mem_used / mem_total * 100
+        spark_text.plain = sparkline(gpu_utilization[i])
+        gpu_text.plain = f"{util_gpu}%"
+        mem_text.plain = f"{memory_utilization:.0f}%" f" ({mem_used // 1024**2} / {mem_total // 1024**2} MB)" f" (Busy: {util_mem}%)"
         
-    return table
+    return GPU_TABLE
 
 layout = make_layout()
 layout["header"].update(Header())
 layout["main"].update(generate_table())
+if deviceCount > 0:
+    update_gpu_stats()
 layout["gpu"].update(gpu_table())
     
 #layout["footer"].update(Footer())
 
-with Live(layout, refresh_per_second=10, screen=True): 
+# repaint only after the data moved, idle links and GPUs cost a slow
+# IDLE_REFRESH_TICKS repaint instead of one every tick
+with Live(layout, auto_refresh=False, screen=True) as live: 
+    ticker = Ticker(INTERVAL)
+    shown_second = int(time())
+    ticks_since_refresh = 0
     while True:
-        layout["main"].update(generate_table())
-        if deviceCount > 0:
+        ticker.wait()
+        ticks_since_refresh += 1
+        changed = monitor.update()
+        if changed:
+            layout["main"].update(generate_table())
+        if deviceCount > 0 and update_gpu_stats():
             layout["gpu"].update(gpu_table())
-        sleep(0.1)
+            changed = True
+        # keep the header clock ticking
+        if int(time()) != shown_second:
+            shown_second = int(time())
+            changed = True
+        if changed or ticks_since_refresh >= IDLE_REFRESH_TICKS:
+            live.refresh()
+            ticks_since_refresh = 0
 
 
 